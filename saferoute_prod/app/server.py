@@ -1,13 +1,28 @@
 """
 Saferoute Web Server - Flask backend for managing WireGuard configs and mappings.
 """
+import atexit
+import io
+import logging
 import os
+import queue
 import subprocess
+import threading
+import time
 import yaml
 from pathlib import Path
 from flask import Flask, jsonify, request, render_template, send_from_directory
+from src.utils import (setup_logging, stat_key, YAML_LOADER, YAML_DUMPER,
+                       enable_ipv4_forwarding, enable_masquerade,
+                       enable_src_valid_mark, enable_forwarding_allow)
 from src.config_store import ConfigStore
 from src.tunnel_manager import TunnelManager
+from src.route_manager import RouteManager
+from src.startup_manager import StartupManager
+from src.dns_manager import IPTABLES_CMD
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__, 
             template_folder='templates',
@@ -19,6 +34,21 @@ WIREGUARD_DIR = os.path.join(CONFIG_DIR, 'wireguard')
 MAPPINGS_FILE = os.path.join(CONFIG_DIR, 'mappings', 'devices.yaml')
 CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.yaml')
 
+# Device mappings are served from memory, keyed by IP (dict order = file order).
+# Mutations update the dict and schedule a write-behind flush of devices.yaml;
+# 'key' is the stat_key() of the file as we last read or wrote it,
+# so edits made by the CLI or an apply run are picked up on next access.
+_MAPPINGS = {}
+_MAPPINGS_LOCK = threading.RLock()
+_MAPPINGS_STATE = {'key': None, 'dirty': False}
+_FLUSH_QUEUE = queue.Queue()
+_FLUSH_DELAY = 0.1  # Seconds to coalesce bursts of mutations into one write
+_FLUSH_RETRY_MAX = 60  # Cap in seconds on the backoff after a failed write
+_flush_thread = None
+
+# Only one apply (startup run) at a time; other requests keep being served
+_APPLY_LOCK = threading.Lock()
+
 
 def ensure_dirs():
     """Ensure required directories exist."""
@@ -26,18 +56,121 @@ def ensure_dirs():
     os.makedirs(os.path.dirname(MAPPINGS_FILE), exist_ok=True)
 
 
-def run_cli(args):
-    """Run a CLI command and return result."""
-    cmd = ['python', '-m', 'src.app'] + args
+# Created once at import rather than on every request
+ensure_dirs()
+
+
+def load_mappings():
+    """
+    Return the in-memory mappings dict, reloading it if devices.yaml changed
+    on disk. Callers must hold _MAPPINGS_LOCK while using the result.
+    """
+    with _MAPPINGS_LOCK:
+        if _MAPPINGS_STATE['dirty']:
+            return _MAPPINGS  # Unflushed local changes win
+        try:
+            key = stat_key(MAPPINGS_FILE)
+        except FileNotFoundError:
+            key = None
+        if key != _MAPPINGS_STATE['key']:
+            devices = []
+            if key is not None:
+                with open(MAPPINGS_FILE) as f:
+                    devices = (yaml.load(f, Loader=YAML_LOADER) or {}).get('devices') or []
+            _MAPPINGS.clear()
+            _MAPPINGS.update((d.get('ip'), d) for d in devices)
+            _MAPPINGS_STATE['key'] = key
+        return _MAPPINGS
+
+
+def flush_mappings():
+    """Write pending mapping changes to devices.yaml."""
+    with _MAPPINGS_LOCK:
+        if not _MAPPINGS_STATE['dirty']:
+            return
+        with open(MAPPINGS_FILE, 'w') as f:
+            yaml.dump({'devices': list(_MAPPINGS.values())}, f,
+                      Dumper=YAML_DUMPER, default_flow_style=False)
+        _MAPPINGS_STATE['key'] = stat_key(MAPPINGS_FILE)
+        _MAPPINGS_STATE['dirty'] = False
+
+
+def _flush_worker():
+    """
+    Write devices.yaml whenever a flush is requested. A failed write is
+    retried with a doubling delay until it succeeds, so a change the API
+    already acknowledged is not left only in memory.
+    """
+    retry_delay = 1
+    while True:
+        _FLUSH_QUEUE.get()
+        time.sleep(_FLUSH_DELAY)
+        # Drop requests queued meanwhile; one write covers them all
+        while True:
+            try:
+                _FLUSH_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            flush_mappings()
+        except Exception as e:
+            logger.error(f"Failed to write {MAPPINGS_FILE}, retrying in {retry_delay}s: {e}")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, _FLUSH_RETRY_MAX)
+            _FLUSH_QUEUE.put(None)
+        else:
+            retry_delay = 1
+
+
+def schedule_flush():
+    """Mark mappings dirty and wake the writer thread (started on first use)."""
+    global _flush_thread
+    with _MAPPINGS_LOCK:
+        _MAPPINGS_STATE['dirty'] = True
+        if _flush_thread is None or not _flush_thread.is_alive():
+            _flush_thread = threading.Thread(target=_flush_worker, name='mappings-flush', daemon=True)
+            _flush_thread.start()
+    _FLUSH_QUEUE.put(None)
+
+
+atexit.register(flush_mappings)
+
+
+def run_startup():
+    """
+    Run the `startup` command in-process and return result.
+    Log records emitted during the run are captured as its output.
+    
+    The capture handler sits on the saferoute loggers ('src.*' and the
+    system setup helpers' 'utils'), not the root logger, so requests served
+    concurrently by other worker threads don't end up in the output.
+    """
+    buffer = io.StringIO()
+    handler = logging.StreamHandler(buffer)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+    capture_loggers = [logging.getLogger('src'), logging.getLogger('utils')]
+    for capture_logger in capture_loggers:
+        capture_logger.addHandler(handler)
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd='/app')
-        return {
-            'success': result.returncode == 0,
-            'stdout': result.stdout,
-            'stderr': result.stderr
-        }
+        enable_ipv4_forwarding()
+        enable_src_valid_mark()
+        enable_masquerade()
+        enable_forwarding_allow()
+
+        store = ConfigStore()
+        with TunnelManager(store) as tm:
+            rm = RouteManager(store)
+            StartupManager(store, tm, rm).startup(CONFIG_FILE)
+        return {'success': True, 'output': buffer.getvalue()}
     except Exception as e:
-        return {'success': False, 'error': str(e)}
+        logger.error(f"Startup failed: {e}")
+        return {'success': False, 'output': buffer.getvalue(), 'error': str(e)}
+    finally:
+        for capture_logger in capture_loggers:
+            capture_logger.removeHandler(handler)
 
 
 # ============ Frontend Routes ============
@@ -53,7 +186,6 @@ def index():
 @app.route('/api/configs', methods=['GET'])
 def list_configs():
     """List all WireGuard config files."""
-    ensure_dirs()
     configs = []
     wg_path = Path(WIREGUARD_DIR)
     
@@ -86,7 +218,6 @@ def get_config(name):
 @app.route('/api/configs', methods=['POST'])
 def create_config():
     """Create a new config file."""
-    ensure_dirs()
     data = request.json
     
     name = data.get('name')
@@ -160,15 +291,9 @@ def delete_config(name):
 @app.route('/api/mappings', methods=['GET'])
 def list_mappings():
     """List all device mappings."""
-    mappings_path = Path(MAPPINGS_FILE)
-    
-    if not mappings_path.exists():
-        return jsonify([])
-    
     try:
-        with open(mappings_path) as f:
-            data = yaml.safe_load(f)
-            return jsonify(data.get('devices', []))
+        with _MAPPINGS_LOCK:
+            return jsonify(list(load_mappings().values()))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -176,7 +301,6 @@ def list_mappings():
 @app.route('/api/mappings', methods=['POST'])
 def add_mapping():
     """Add a new device mapping."""
-    ensure_dirs()
     data = request.json
     
     ip = data.get('ip')
@@ -187,30 +311,19 @@ def add_mapping():
     if not ip or not tunnel:
         return jsonify({'error': 'IP and tunnel required'}), 400
     
-    # Load existing mappings
-    mappings_path = Path(MAPPINGS_FILE)
-    if mappings_path.exists():
-        with open(mappings_path) as f:
-            config = yaml.safe_load(f) or {}
-    else:
-        config = {}
-    
-    devices = config.get('devices', [])
-    
-    # Check if IP already exists
-    for d in devices:
-        if d.get('ip') == ip:
+    with _MAPPINGS_LOCK:
+        mappings = load_mappings()
+        
+        # Check if IP already exists
+        if ip in mappings:
             return jsonify({'error': 'IP already mapped'}), 409
-    
-    mapping = {'ip': ip, 'tunnel': tunnel, 'active': active}
-    if nickname:
-        mapping['nickname'] = nickname
-    
-    devices.append(mapping)
-    config['devices'] = devices
-    
-    with open(mappings_path, 'w') as f:
-        yaml.dump(config, f, default_flow_style=False)
+        
+        mapping = {'ip': ip, 'tunnel': tunnel, 'active': active}
+        if nickname:
+            mapping['nickname'] = nickname
+        
+        mappings[ip] = mapping
+        schedule_flush()
     
     return jsonify({
         'success': True,
@@ -229,36 +342,20 @@ def update_mapping(ip):
     if not new_tunnel:
         return jsonify({'error': 'Tunnel required'}), 400
     
-    mappings_path = Path(MAPPINGS_FILE)
-    if not mappings_path.exists():
-        return jsonify({'error': 'No mappings file'}), 404
-    
-    with open(mappings_path) as f:
-        config = yaml.safe_load(f) or {}
-    
-    devices = config.get('devices', [])
-    found = False
-    
-    for d in devices:
-        if d.get('ip') == ip:
-            d['tunnel'] = new_tunnel
-            if nickname:
-                d['nickname'] = nickname
-            elif 'nickname' in d:
-                # Remove nickname if empty string provided
-                del d['nickname']
-            if active is not None:
-                d['active'] = active
-            found = True
-            break
-    
-    if not found:
-        return jsonify({'error': 'Mapping not found'}), 404
-    
-    config['devices'] = devices
-    
-    with open(mappings_path, 'w') as f:
-        yaml.dump(config, f, default_flow_style=False)
+    with _MAPPINGS_LOCK:
+        d = load_mappings().get(ip)
+        if d is None:
+            return jsonify({'error': 'Mapping not found'}), 404
+        
+        d['tunnel'] = new_tunnel
+        if nickname:
+            d['nickname'] = nickname
+        elif 'nickname' in d:
+            # Remove nickname if empty string provided
+            del d['nickname']
+        if active is not None:
+            d['active'] = active
+        schedule_flush()
     
     return jsonify({
         'success': True,
@@ -269,14 +366,12 @@ def update_mapping(ip):
 @app.route('/api/mappings/<path:ip>', methods=['DELETE'])
 def delete_mapping(ip):
     """Delete a device mapping and clean up rules."""
-    mappings_path = Path(MAPPINGS_FILE)
-    if not mappings_path.exists():
-        return jsonify({'error': 'No mappings file'}), 404
+    with _MAPPINGS_LOCK:
+        if ip not in load_mappings():
+            return jsonify({'error': 'Mapping not found'}), 404
     
     # Clean up rules before deleting from file
     try:
-        from src.route_manager import RouteManager
-        from src.config_store import ConfigStore
         from pyroute2 import IPRoute
         
         store = ConfigStore()
@@ -293,24 +388,13 @@ def delete_mapping(ip):
                 pass
     except Exception as e:
         # Log warning but continue with delete
-        import logging
-        logging.getLogger(__name__).warning(f"Failed to cleanup rules for {ip}: {e}")
+        logger.warning(f"Failed to cleanup rules for {ip}: {e}")
     
     # Original delete logic (remove from YAML)
-    with open(mappings_path) as f:
-        config = yaml.safe_load(f) or {}
-    
-    devices = config.get('devices', [])
-    original_len = len(devices)
-    devices = [d for d in devices if d.get('ip') != ip]
-    
-    if len(devices) == original_len:
-        return jsonify({'error': 'Mapping not found'}), 404
-    
-    config['devices'] = devices
-    
-    with open(mappings_path, 'w') as f:
-        yaml.dump(config, f, default_flow_style=False)
+    with _MAPPINGS_LOCK:
+        if load_mappings().pop(ip, None) is None:
+            return jsonify({'error': 'Mapping not found'}), 404
+        schedule_flush()
     
     return jsonify({
         'success': True,
@@ -323,19 +407,31 @@ def delete_mapping(ip):
 @app.route('/api/apply', methods=['POST'])
 def apply_changes():
     """Apply all changes by running startup command."""
-    result = run_cli(['startup', CONFIG_FILE])
+    if not _APPLY_LOCK.acquire(blocking=False):
+        return jsonify({
+            'success': False,
+            'message': 'Failed to apply changes',
+            'error': 'Apply already in progress'
+        }), 409
+    try:
+        # Startup reads devices.yaml, so write out any pending edits first
+        flush_mappings()
+        result = run_startup()
+    finally:
+        _APPLY_LOCK.release()
     
     if result['success']:
         return jsonify({
             'success': True,
             'message': 'Changes applied successfully',
-            'output': result['stdout']
+            'output': result['output']
         })
     else:
         return jsonify({
             'success': False,
             'message': 'Failed to apply changes',
-            'error': result.get('stderr', result.get('error', 'Unknown error'))
+            'error': result['error'],
+            'output': result['output']
         }), 500
 
 
@@ -344,10 +440,12 @@ def apply_changes():
 def get_status():
     """Get current tunnel status."""
     try:
-        result = subprocess.run(['wg', 'show'], capture_output=True, text=True)
+        store = ConfigStore()
+        with TunnelManager(store) as tm:
+            output = tm.get_wireguard_status()
         return jsonify({
             'success': True,
-            'output': result.stdout if result.stdout else 'No tunnels active'
+            'output': output if output else 'No tunnels active'
         })
     except Exception as e:
         return jsonify({
@@ -361,8 +459,8 @@ def get_stats():
     """Get traffic statistics for active tunnels."""
     try:
         store = ConfigStore()
-        tm = TunnelManager(store)
-        stats = tm.get_tunnel_stats()
+        with TunnelManager(store) as tm:
+            stats = tm.get_tunnel_stats()
         return jsonify(stats)
     except Exception as e:
         return jsonify({
@@ -395,7 +493,8 @@ def debug_dns():
             }
         
         # Get mappings with DNS status
-        mappings = rm.load_mappings()
+        with _MAPPINGS_LOCK:
+            mappings = [dict(m) for m in load_mappings().values()]
         mappings_with_dns = []
         for m in mappings:
             dns_info = rm.dns_manager.get_dns_rules_for_client(m['ip'])
@@ -424,12 +523,12 @@ def debug_iptables():
     """
     try:
         # Get NAT table (where DNS DNAT rules are)
-        nat_result = subprocess.run(['iptables', '-t', 'nat', '-L', '-n', '-v'], 
-                                   capture_output=True, text=True)
+        nat_result = subprocess.run([IPTABLES_CMD, '-t', 'nat', '-L', '-n', '-v'], 
+                                   capture_output=True, text=True, close_fds=False)
         
         # Get filter table
-        filter_result = subprocess.run(['iptables', '-L', '-n', '-v'],
-                                      capture_output=True, text=True)
+        filter_result = subprocess.run([IPTABLES_CMD, '-L', '-n', '-v'],
+                                      capture_output=True, text=True, close_fds=False)
         
         return jsonify({
             'success': True,
@@ -443,6 +542,28 @@ def debug_iptables():
         }), 500
 
 
+def serve(host, port):
+    """
+    Serve the app with gunicorn's threaded worker.
+    A single worker process is used because mappings are held in memory;
+    concurrency comes from its thread pool.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', 1)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', 8)
+            self.cfg.set('accesslog', '-')
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    serve('0.0.0.0', port)
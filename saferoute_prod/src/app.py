@@ -140,12 +140,9 @@ def start():
     tm = TunnelManager(store)
     rm = RouteManager(store)
     
-    profiles = store.list_profiles()
-    for name in profiles:
-        try:
-            tm.setup_tunnel(name)
-        except Exception as e:
-            logger.error(f"Failed to setup tunnel {name}: {e}")
+    # Tunnels come up concurrently; each worker reuses its own netlink handle
+    tm.setup_tunnels(store.list_profiles())
+    tm.close()
 
     # 3. Apply Rules
     rm.sync_rules()
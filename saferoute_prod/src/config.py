@@ -10,3 +10,7 @@ DEVICES_FILE = os.path.join(DATA_DIR, "devices.json")   # Stores device mapping
 TABLE_OFFSET = 100
 PRIORITY_OFFSET = 50
 DEVICE_PRIORITY_BASE = 1000
+
+# Tunnel Setup
+MAX_SETUP_WORKERS = 8   # Tunnels brought up concurrently
+ENDPOINT_CACHE_TTL = 60 # Seconds a resolved endpoint address is reused
@@ -1,9 +1,12 @@
 import os
 import json
 import shutil
-import configparser
+import bisect
+import functools
 import logging
 from pathlib import Path
+from .config import TABLE_OFFSET
+from .utils import stat_key
 
 logger = logging.getLogger(__name__)
 
@@ -13,26 +16,72 @@ WIREGUARD_DIR = os.path.join(CONFIG_DIR, 'wireguard')
 PROFILES_FILE = os.path.join(CONFIG_DIR, 'profiles.json')
 
 class ConfigStore:
+    # Parsed profiles.json shared by all instances, keyed by stat_key()
+    _profiles_cache = (None, {})
+    _dirs_ensured = False
+
     def __init__(self):
-        self.profiles = {}
+        # Loaded on first access, so callers that never look at profiles
+        # (e.g. stats or debug endpoints) skip the stat and JSON parse
+        self._profiles = None
+        self._table_ids = None  # Sorted, unique
         self._ensure_dirs()
-        self._load_profiles()
+    
+    @property
+    def profiles(self):
+        if self._profiles is None:
+            self._load_profiles()
+        return self._profiles
+    
+    @property
+    def _used_table_ids(self):
+        if self._table_ids is None:
+            self._load_profiles()
+        return self._table_ids
     
     def _ensure_dirs(self):
+        if ConfigStore._dirs_ensured:
+            return
         os.makedirs(WIREGUARD_DIR, exist_ok=True)
+        ConfigStore._dirs_ensured = True
     
     def _load_profiles(self):
-        if os.path.exists(PROFILES_FILE):
-            with open(PROFILES_FILE, 'r') as f:
-                self.profiles = json.load(f)
+        self._profiles = {}
+        self._table_ids = []
+        try:
+            key = stat_key(PROFILES_FILE)
+        except FileNotFoundError:
+            return
+        cached_key, cached = ConfigStore._profiles_cache
+        if key != cached_key:
+            with open(PROFILES_FILE, 'rb') as f:
+                cached = json.loads(f.read())
+            ConfigStore._profiles_cache = (key, cached)
+        # Shallow copy: profile entries are replaced, never mutated in place
+        self._profiles = dict(cached)
+        self._table_ids = sorted({p['table_id'] for p in self._profiles.values()})
     
     def _save_profiles(self):
         with open(PROFILES_FILE, 'w') as f:
             json.dump(self.profiles, f, indent=2)
+        ConfigStore._profiles_cache = (stat_key(PROFILES_FILE), dict(self.profiles))
     
     def _allocate_table_id(self):
-        existing_ids = [p['table_id'] for p in self.profiles.values()]
-        return max(existing_ids, default=99) + 1
+        """
+        Return the lowest free routing table id at or above TABLE_OFFSET.
+        Ids are sorted and unique, so ids[i] - i stays constant until the
+        first gap; that lets us bisect for it instead of scanning.
+        """
+        ids = self._used_table_ids
+        base = lo = bisect.bisect_left(ids, TABLE_OFFSET)
+        hi = len(ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ids[mid] - mid == TABLE_OFFSET - base:
+                lo = mid + 1
+            else:
+                hi = mid
+        return TABLE_OFFSET + (lo - base)
     
     def import_config(self, source_path, name):
         """Import a WireGuard config file."""
@@ -51,7 +100,7 @@ class ConfigStore:
         dest_abs = os.path.abspath(dest_path)
         
         if source_abs != dest_abs:
-            shutil.copy(source_path, dest_path)
+            shutil.copyfile(source_path, dest_path)
             logger.info(f"Copied config from {source_path} to {dest_path}")
         else:
             logger.info(f"Config already in correct location: {dest_path}")
@@ -69,6 +118,7 @@ class ConfigStore:
             "address": parsed['Interface'].get('Address'),
             "dns_servers": parsed.get('dns_servers', [])
         }
+        bisect.insort(self._used_table_ids, table_id)
         self._save_profiles()
         logger.info(f"Imported profile '{name}' (Table {table_id})")
         return self.profiles[name]
@@ -83,6 +133,7 @@ class ConfigStore:
             os.remove(config_path)
         
         # Remove from profiles
+        self._used_table_ids.remove(self.profiles[name]['table_id'])
         del self.profiles[name]
         self._save_profiles()
         logger.info(f"Deleted profile '{name}'")
@@ -93,29 +144,66 @@ class ConfigStore:
     def list_profiles(self):
         return self.profiles
 
+    def list_profile_names(self):
+        return set(self.profiles)
+
     def _parse_wg_config(self, path):
-        config = configparser.ConfigParser()
-        config.optionxform = str # Preserve case for WireGuard keys
+        """
+        Parse a WireGuard config file.
+        Results are cached until the file's mtime or size changes; callers
+        must treat the returned dict as read-only.
+        """
         try:
-            config.read(path)
-        except Exception as e:
+            mtime_ns, size = stat_key(path)
+        except OSError as e:
             raise ValueError(f"Invalid config file: {e}")
+        return _parse_wg_config_cached(os.path.abspath(path), mtime_ns, size)
 
-        if 'Interface' not in config:
-            raise ValueError("Missing [Interface] section")
-        
-        # Taking first available peer
-        peers = [s for s in config.sections() if s == 'Peer']
-        if not peers:
-             raise ValueError("Missing [Peer] section")
-        
-        # Parse DNS servers from Interface section
-        interface_dict = dict(config['Interface'])
-        dns_str = interface_dict.get('DNS', '')
-        dns_servers = [s.strip() for s in dns_str.split(',') if s.strip()]
-        
-        return {
-            'Interface': interface_dict,
-            'Peer': dict(config[peers[0]]),
-            'dns_servers': dns_servers
-        }
+
+def _read_wg_sections(path):
+    """
+    Minimal INI reader for WireGuard configs: `[Section]` headers and
+    `Key = Value` lines. Keys keep their case; the first section of each
+    name wins (e.g. the first [Peer]).
+    """
+    sections = {}
+    current = None
+    try:
+        with open(path, 'r') as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line[0] in '#;':
+                    continue
+                if line[0] == '[' and line[-1] == ']':
+                    name = line[1:-1].strip()
+                    current = {} if name in sections else sections.setdefault(name, {})
+                    continue
+                key, sep, value = line.partition('=')
+                if current is None or not sep:
+                    raise ValueError(f"line {lineno}: {line!r}")
+                current[key.strip()] = value.strip()
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid config file: {e}")
+    return sections
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_wg_config_cached(path, mtime_ns, size):
+    config = _read_wg_sections(path)
+
+    if 'Interface' not in config:
+        raise ValueError("Missing [Interface] section")
+    
+    if 'Peer' not in config:
+         raise ValueError("Missing [Peer] section")
+    
+    # Parse DNS servers from Interface section
+    interface_dict = config['Interface']
+    dns_str = interface_dict.get('DNS', '')
+    dns_servers = [s.strip() for s in dns_str.split(',') if s.strip()]
+    
+    return {
+        'Interface': interface_dict,
+        'Peer': config['Peer'],
+        'dns_servers': dns_servers
+    }
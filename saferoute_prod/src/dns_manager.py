@@ -1,17 +1,96 @@
 """
-DNS Manager - Prevents DNS leaks by managing iptables DNAT rules.
+DNS Manager - Prevents DNS leaks by managing iptables/nftables DNAT rules.
 
 This module sets up iptables rules to redirect DNS queries (port 53)
 from client IPs to use the VPN provider's DNS servers through the tunnel.
 """
+import functools
+import ipaddress
+import json
 import logging
+import re
 import subprocess
 import shutil
 
 logger = logging.getLogger(__name__)
 
-# Detect which iptables command to use (legacy vs nf_tables)
-IPTABLES_CMD = 'iptables-legacy' if shutil.which('iptables-legacy') else 'iptables'
+# Detect which iptables command to use (legacy vs nf_tables).
+# Resolved to absolute paths so subprocess can take its posix_spawn fast
+# path (together with close_fds=False; Python-created fds are non-inheritable).
+_IPTABLES_NAME = 'iptables-legacy' if shutil.which('iptables-legacy') else 'iptables'
+IPTABLES_CMD = shutil.which(_IPTABLES_NAME) or _IPTABLES_NAME
+IPTABLES_SAVE_CMD = shutil.which(f'{_IPTABLES_NAME}-save') or f'{_IPTABLES_NAME}-save'
+IPTABLES_RESTORE_CMD = shutil.which(f'{_IPTABLES_NAME}-restore') or f'{_IPTABLES_NAME}-restore'
+
+# Each client's DNAT rules live in its own nat chain, reached from a single
+# PREROUTING rule matching the client's source address. Packets from other
+# clients skip it after one comparison instead of walking every client's
+# UDP and TCP rules.
+_CHAIN_PREFIX = 'sr_dns_'
+
+# Lines of interest in `iptables-save -t nat` output:
+#   :sr_dns_192_168_1_10 - [0:0]
+#   -A PREROUTING -s 192.168.1.10/32 -j sr_dns_192_168_1_10
+#   -A sr_dns_192_168_1_10 -p udp -m udp --dport 53 -j DNAT --to-destination 8.8.8.8:53
+# plus direct rules written by older versions:
+#   -A PREROUTING -s 192.168.1.10/32 -p udp -m udp --dport 53 -j DNAT --to-destination 8.8.8.8:53
+_CHAIN_DECL_RE = re.compile(rf'^:(?P<chain>{_CHAIN_PREFIX}\S+) ', re.M)
+_DISPATCH_RE = re.compile(
+    rf'^(?P<rule>-A PREROUTING -s (?P<src>[^\s/]+)(?:/32)? -j {_CHAIN_PREFIX}\S+)\s*$',
+    re.M
+)
+_DNAT_RULE_RE = re.compile(
+    r'^(?P<rule>-A (?P<chain>\S+) (?:-s (?P<src>[^\s/]+)(?:/32)? )?.*?--dport 53 .*?'
+    r'-j DNAT --to-destination (?P<dst>[^:\s]+):53)\s*$',
+    re.M
+)
+
+# nftables backend, used when `nft` is installed: one map lookup per packet
+# no matter how many clients there are, and adding or removing a client is a
+# single map element instead of a chain.
+NFT_CMD = shutil.which('nft')
+_NFT_TABLE = 'saferoute'
+_NFT_MAP = 'dns_map'
+# Idempotent: re-running it leaves existing map elements alone. Prepended to
+# every script, so a flushed ruleset (e.g. a firewall reload) is recreated
+_NFT_SETUP = f"""add table ip {_NFT_TABLE}
+add map ip {_NFT_TABLE} {_NFT_MAP} {{ type ipv4_addr : ipv4_addr; }}
+add chain ip {_NFT_TABLE} dns_prerouting {{ type nat hook prerouting priority -100; policy accept; }}
+flush chain ip {_NFT_TABLE} dns_prerouting
+add rule ip {_NFT_TABLE} dns_prerouting meta l4proto {{ udp, tcp }} th dport 53 dnat to ip saddr map @{_NFT_MAP}
+"""
+
+
+def _is_ipv4(addr):
+    """True if addr is an IPv4 address string; the nat table and dns_map are IPv4 only."""
+    try:
+        ipaddress.IPv4Address(addr)
+    except ValueError:
+        return False
+    return isinstance(addr, str)
+
+
+def _client_chain(client_ip):
+    """Name of the nat chain holding client_ip's DNS rules (max 28 chars)."""
+    return _CHAIN_PREFIX + client_ip.replace('.', '_')
+
+
+def _chain_client(chain):
+    """Inverse of _client_chain()."""
+    return chain[len(_CHAIN_PREFIX):].replace('_', '.')
+
+
+@functools.lru_cache(maxsize=64)
+def _dnat_matches(primary_dns):
+    """
+    Client-independent UDP and TCP (needed for large responses) DNAT rule
+    bodies. Most clients share their provider's DNS server, so a burst of
+    setups reuses the same strings.
+    """
+    return tuple(
+        f'-p {proto} -m {proto} --dport 53 -j DNAT --to-destination {primary_dns}:53'
+        for proto in ('udp', 'tcp')
+    )
 
 
 class DNSManager:
@@ -19,12 +98,119 @@ class DNSManager:
     Manages DNS routing using iptables DNAT rules to prevent DNS leaks.
     
     Tracks active DNS rules per client IP for debugging and cleanup.
+    Each client gets its own sr_dns_<ip> chain (see _client_chain()).
+    
+    Rules are read from _iptables_save(): its output is stable, never
+    reverse-resolves addresses, and each line is the exact spec needed
+    to delete that rule again.
+    
+    Rule changes go through _iptables_restore(), so a whole batch costs one
+    process spawn and one xtables lock acquisition.
+    
+    When nft is available, clients are instead entries in the nftables
+    dns_map (client IP -> DNS server IP) behind a single DNAT rule; the
+    iptables path remains the fallback and still cleans up rules left
+    behind by it.
     """
     
+    # Cleared for the rest of the process if the nftables setup fails
+    # (e.g. no nf_tables support in the kernel)
+    _use_nft = NFT_CMD is not None
+    _nft_ready = False
+    
     def __init__(self):
         """Initialize DNS manager with empty rule tracking."""
         # Track active DNS rules: {ip_addr: {dns_servers: [...], primary_dns: str}}
         self.active_rules = {}
+        # Until the nat table has been scanned once, rules left over from an
+        # earlier run may exist for any IP; afterwards only the untracked IPs
+        # seen in that scan can have rules we don't know about
+        self._first_run = True
+        self._untracked_ips = set()
+    
+    def _iptables_save(self):
+        """Return the nat table in `iptables-save` format."""
+        result = subprocess.run([IPTABLES_SAVE_CMD, '-t', 'nat'],
+                                capture_output=True, text=True, check=True, close_fds=False)
+        return result.stdout
+    
+    def _iptables_restore(self, rules, chains=()):
+        """
+        Apply nat table rule lines (e.g. '-I PREROUTING ...') atomically
+        with a single `iptables-restore --noflush`. Each of chains is
+        created, or flushed if it already exists, before the rules run.
+        """
+        blob = '*nat\n' + ''.join(f':{chain} - [0:0]\n' for chain in chains)
+        blob += '\n'.join(rules) + '\nCOMMIT\n'
+        subprocess.run([IPTABLES_RESTORE_CMD, '--noflush'], input=blob,
+                       capture_output=True, text=True, check=True, close_fds=False)
+    
+    @staticmethod
+    def _dnat_rules(client_ip, primary_dns):
+        """
+        Rule lines filling the client's chain with its DNAT rules and
+        hooking it into PREROUTING.
+        The chain itself must be declared in the same restore.
+        """
+        chain = _client_chain(client_ip)
+        return [f'-A {chain} {match}' for match in _dnat_matches(primary_dns)] + [
+            f'-I PREROUTING -s {client_ip} -j {chain}'
+        ]
+    
+    @staticmethod
+    def _unhook_rules(client_ip):
+        """Rule lines removing the client's PREROUTING hook and chain."""
+        chain = _client_chain(client_ip)
+        return [f'-D PREROUTING -s {client_ip} -j {chain}', f'-F {chain}', f'-X {chain}']
+    
+    def _nft(self, script):
+        """
+        Run an nft script atomically with a single `nft -f -`, after the
+        table, dns_map and DNAT rule setup in the same transaction.
+        """
+        subprocess.run([NFT_CMD, '-f', '-'], input=_NFT_SETUP + script,
+                       capture_output=True, text=True, check=True, close_fds=False)
+    
+    def _nft_setup(self):
+        """
+        Check once per process that nftables is usable (creating the
+        saferoute table on the way).
+        Returns False (and switches to iptables) if it is not.
+        """
+        if DNSManager._nft_ready:
+            return True
+        try:
+            self._nft('')
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"nftables unavailable, using iptables for DNS rules: {getattr(e, 'stderr', e)}")
+            DNSManager._use_nft = False
+            return False
+        DNSManager._nft_ready = True
+        return True
+    
+    def _nft_map_elements(self):
+        """
+        Return the dns_map contents as {client_ip: dns_ip}. Read-only: a
+        missing table (never set up, or flushed) means an empty map.
+        """
+        try:
+            result = subprocess.run([
+                NFT_CMD, '-j', 'list', 'map', 'ip', _NFT_TABLE, _NFT_MAP
+            ], capture_output=True, text=True, check=True, close_fds=False)
+        except subprocess.CalledProcessError as e:
+            logger.debug(f"No dns_map to list: {e.stderr}")
+            return {}
+        elements = {}
+        for item in json.loads(result.stdout).get('nftables', []):
+            for elem in item.get('map', {}).get('elem', []):
+                if isinstance(elem, list) and len(elem) == 2:
+                    elements[elem[0]] = elem[1]
+        return elements
+    
+    @staticmethod
+    def _nft_elements(action, items):
+        """`add`/`delete element` line for dns_map; items are 'ip' or 'ip : dns'."""
+        return f"{action} element ip {_NFT_TABLE} {_NFT_MAP} {{ {', '.join(items)} }}\n"
     
     def setup_dns_for_client(self, client_ip: str, dns_servers: list, table_id: int):
         """
@@ -39,96 +225,259 @@ class DNSManager:
         if not dns_servers:
             logger.warning(f"No DNS servers provided for {client_ip}")
             return
+        self.setup_dns_for_clients([(client_ip, dns_servers, table_id)])
+    
+    def setup_dns_for_clients(self, clients, cleanup=True, remove=()):
+        """
+        Set up DNS DNAT rules for many clients in one transaction.
         
-        # Clean up any existing rules for this client first
-        self.cleanup_dns_for_client(client_ip)
+        When cleaning up, the clients' old rules are found with one
+        snapshot and replaced in the same iptables-restore (or nft script)
+        that adds the new ones, so there is no window without DNS rules.
         
-        logger.info(f"Setting up DNS DNAT for {client_ip} -> {dns_servers}")
+        Args:
+            clients: Iterable of (client_ip, dns_servers, table_id) tuples;
+                entries without DNS servers or with an invalid client or
+                primary DNS address are skipped with a warning, so one bad
+                mapping cannot fail the whole batch
+            cleanup: Remove the clients' existing rules first; pass False
+                when the caller has just done so
+            remove: Further client IPs whose rules are removed in the same
+                transaction (e.g. inactive mappings)
+        """
+        valid = []
+        remove = set(remove)
+        for client in clients:
+            client_ip, dns_servers = client[0], client[1]
+            if not dns_servers:
+                logger.warning(f"No DNS servers provided for {client_ip}")
+            elif not _is_ipv4(client_ip):
+                logger.warning(f"Skipping DNS rules for invalid client IP {client_ip!r}")
+            elif not _is_ipv4(dns_servers[0]):
+                logger.warning(f"Skipping DNS rules for {client_ip}: invalid DNS server {dns_servers[0]!r}")
+                # Still drop the client's old rules, as a failed setup would
+                remove.add(client_ip)
+            else:
+                valid.append(client)
+        clients = valid
         
-        # Use first DNS server (most VPN configs list primary first)
-        primary_dns = dns_servers[0]
+        # A lone client can use the tracked (no snapshot) cleanup path
+        if cleanup and len(clients) == 1 and not remove:
+            self.cleanup_dns_for_client(clients[0][0])
+            cleanup = False
         
-        try:
-            # Add UDP DNS redirect rule
-            subprocess.run([
-                IPTABLES_CMD, '-t', 'nat', '-I', 'PREROUTING',
-                '-s', client_ip,
-                '-p', 'udp', '--dport', '53',
-                '-j', 'DNAT', '--to-destination', f'{primary_dns}:53'
-            ], check=True, capture_output=True, text=True)
-            logger.debug(f"Added UDP DNS rule: {client_ip}:53 -> {primary_dns}:53")
-            
-            # Add TCP DNS redirect rule (needed for large responses)
-            subprocess.run([
-                IPTABLES_CMD, '-t', 'nat', '-I', 'PREROUTING',
-                '-s', client_ip,
-                '-p', 'tcp', '--dport', '53',
-                '-j', 'DNAT', '--to-destination', f'{primary_dns}:53'
-            ], check=True, capture_output=True, text=True)
-            logger.debug(f"Added TCP DNS rule: {client_ip}:53 -> {primary_dns}:53")
+        use_nft = self._use_nft and self._nft_setup()
+        rules = []
+        chains = []
+        pending = {}
+        for client_ip, dns_servers, table_id in clients:
+            logger.info(f"Setting up DNS DNAT for {client_ip} -> {dns_servers}")
             
-            # Track the rules for debugging and cleanup
-            self.active_rules[client_ip] = {
+            # Use first DNS server (most VPN configs list primary first)
+            primary_dns = dns_servers[0]
+            chains.append(_client_chain(client_ip))
+            rules.extend(self._dnat_rules(client_ip, primary_dns))
+            pending[client_ip] = {
                 'dns_servers': dns_servers,
                 'primary_dns': primary_dns,
-                'table_id': table_id
+                'table_id': table_id,
+                'nft': use_nft
             }
-            
-            logger.info(f"DNS leak prevention active for {client_ip}")
-            
+        
+        clear = remove | set(pending) if cleanup else remove
+        if not pending and not clear:
+            return
+        
+        untracked = None
+        try:
+            # Chains re-declared by the restore below are flushed, not deleted
+            keep_chains = () if use_nft else chains
+            stale_rules, stale_mapped = [], []
+            if clear:
+                stale_rules, stale_mapped, untracked = self._removal_ops(clear, keep_chains)
+            if use_nft:
+                script = ''
+                if stale_mapped:
+                    script += self._nft_elements('delete', stale_mapped)
+                if pending:
+                    script += self._nft_elements(
+                        'add', [f"{ip} : {rule['primary_dns']}" for ip, rule in pending.items()]
+                    )
+                if script:
+                    self._nft(script)
+                if stale_rules:
+                    # Left over from before nftables
+                    self._iptables_restore(stale_rules)
+            elif stale_rules or rules:
+                self._iptables_restore(stale_rules + rules, chains)
         except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to setup DNS rules for {client_ip}: {e.stderr}")
-            # Attempt cleanup if partial setup
-            self.cleanup_dns_for_client(client_ip)
+            # The restore is atomic, but the nft script and the iptables
+            # leftovers are two steps: let the next cleanup rescan them all
+            self._untracked_ips |= clear | pending.keys()
+            logger.error(f"Failed to setup DNS rules for {', '.join(pending)}: {e.stderr}")
             raise
+        
+        # Track the rules for debugging and cleanup
+        if untracked is not None:
+            self._untracked_ips = untracked
+            self._first_run = False
+        for client_ip in clear:
+            self.active_rules.pop(client_ip, None)
+        self.active_rules.update(pending)
+        for client_ip, rule in pending.items():
+            logger.debug(f"Added UDP/TCP DNS rules: {client_ip}:53 -> {rule['primary_dns']}:53")
+            logger.info(f"DNS leak prevention active for {client_ip}")
     
     def cleanup_dns_for_client(self, client_ip: str):
         """
         Remove all DNS DNAT rules for a specific client IP.
         
+        Rules this instance installed are deleted by their exact spec;
+        otherwise (e.g. after a restart) this falls back to
+        cleanup_dns_for_clients(). Either way it is one restore.
+        
         Args:
             client_ip: IP address of the client device
         """
         logger.info(f"Cleaning up DNS rules for {client_ip}")
         
+        tracked = self.active_rules.pop(client_ip, None)
+        if tracked:
+            try:
+                if tracked.get('nft'):
+                    self._nft(self._nft_elements('delete', [client_ip]))
+                else:
+                    self._iptables_restore(self._unhook_rules(client_ip))
+                logger.info(f"DNS cleanup complete for {client_ip}")
+                return
+            except subprocess.CalledProcessError as e:
+                # Rules changed behind our back; fall back to a full scan
+                logger.debug(f"Tracked DNS rules for {client_ip} not found: {e.stderr}")
+        elif not self._first_run and client_ip not in self._untracked_ips:
+            logger.debug(f"No DNS rules to clean for {client_ip}")
+            return
+        
+        self.cleanup_dns_for_clients([client_ip])
+    
+    def _snapshot_dnat_rules(self):
+        """
+        Dump the nat table (and the nftables dns_map, if in use) once and
+        index the DNS DNAT rules by source IP.
+        
+        Returns:
+            dict mapping client IPs to {'rules': [...], 'chain': str or None,
+            'mapped': bool, 'dns_servers': [...]}, where 'rules' are the
+            client's '-A PREROUTING ...' lines, 'chain' its per-client chain
+            and 'mapped' whether it has a dns_map element
+        """
+        rules = {}
+        
+        def entry(client_ip):
+            return rules.setdefault(client_ip, {
+                'rules': [], 'chain': None, 'mapped': False, 'dns_servers': []
+            })
+        
+        if self._use_nft:
+            for client_ip, dns_ip in self._nft_map_elements().items():
+                client = entry(client_ip)
+                client['mapped'] = True
+                client['dns_servers'].append(dns_ip)
+            # Still look for iptables rules left over from before nftables
+            try:
+                dump = self._iptables_save()
+            except (OSError, subprocess.CalledProcessError) as e:
+                # No iptables, or no legacy nat table on an nftables-only host
+                logger.debug(f"No iptables nat table to scan: {getattr(e, 'stderr', None) or e}")
+                return rules
+        else:
+            dump = self._iptables_save()
+        for m in _CHAIN_DECL_RE.finditer(dump):
+            entry(_chain_client(m['chain']))['chain'] = m['chain']
+        for m in _DISPATCH_RE.finditer(dump):
+            entry(m['src'])['rules'].append(m['rule'])
+        for m in _DNAT_RULE_RE.finditer(dump):
+            if m['chain'] == 'PREROUTING' and m['src']:
+                client = entry(m['src'])
+                client['rules'].append(m['rule'])
+            elif m['chain'].startswith(_CHAIN_PREFIX):
+                client = entry(_chain_client(m['chain']))
+            else:
+                continue
+            if m['dst'] not in client['dns_servers']:
+                client['dns_servers'].append(m['dst'])
+        return rules
+    
+    def _removal_ops(self, client_ips, keep_chains=()):
+        """
+        Snapshot once and work out what removes every DNS rule for client_ips.
+        
+        Chains in keep_chains are re-declared (and so flushed) by the
+        caller's restore, so they are unhooked but not deleted.
+        
+        The snapshot also yields the IPs with rules this instance does not
+        track; callers record them (and clear _first_run) only once the
+        removal has been applied.
+        
+        Returns:
+            (iptables restore lines, IPs with a dns_map element,
+            untracked IPs outside client_ips)
+        """
+        snapshot = self._snapshot_dnat_rules()
+        untracked = set(snapshot) - client_ips - self.active_rules.keys()
+        
+        # Delete by exact spec (each '-A ...' line becomes '-D ...'),
+        # then drop the now unreferenced chains
+        rules_to_delete = []
+        chains_to_delete = []
+        mapped = []
+        for client_ip in client_ips:
+            client = snapshot.get(client_ip)
+            if not client:
+                continue
+            rules_to_delete.extend('-D' + rule[2:] for rule in client['rules'])
+            if client['chain'] and client['chain'] not in keep_chains:
+                chains_to_delete.append(client['chain'])
+            if client['mapped']:
+                mapped.append(client_ip)
+        for chain in chains_to_delete:
+            rules_to_delete.extend([f'-F {chain}', f'-X {chain}'])
+        return rules_to_delete, mapped, untracked
+    
+    def cleanup_dns_for_clients(self, client_ips):
+        """
+        Remove all DNS DNAT rules for many clients with one listing and
+        one iptables-restore.
+        
+        Args:
+            client_ips: Iterable of client device IPs
+        """
+        client_ips = set(client_ips)
+        if not client_ips:
+            return
+        
         try:
-            # Get current rules and find line numbers for this client
-            result = subprocess.run([
-                IPTABLES_CMD, '-t', 'nat', '-L', 'PREROUTING', '-n', '--line-numbers'
-            ], capture_output=True, text=True, check=True)
-            
-            # Find all line numbers for DNS rules matching this client IP
-            lines_to_delete = []
-            for line in result.stdout.split('\n'):
-                if client_ip in line and 'dpt:53' in line and 'DNAT' in line:
-                    # Extract line number (first column)
-                    parts = line.split()
-                    if parts and parts[0].isdigit():
-                        lines_to_delete.append(int(parts[0]))
-            
-            # Delete rules in reverse order (so line numbers don't shift)
-            for line_num in sorted(lines_to_delete, reverse=True):
-                try:
-                    subprocess.run([
-                        IPTABLES_CMD, '-t', 'nat', '-D', 'PREROUTING', str(line_num)
-                    ], capture_output=True, text=True, check=True)
-                    logger.debug(f"Deleted DNS rule at line {line_num} for {client_ip}")
-                except subprocess.CalledProcessError as e:
-                    logger.warning(f"Failed to delete rule at line {line_num}: {e.stderr}")
-            
-            if lines_to_delete:
-                logger.info(f"DNS cleanup complete for {client_ip} ({len(lines_to_delete)} rules removed)")
+            rules_to_delete, mapped, untracked = self._removal_ops(client_ips)
+            if mapped:
+                self._nft(self._nft_elements('delete', mapped))
+            if rules_to_delete:
+                self._iptables_restore(rules_to_delete)
+            if mapped or rules_to_delete:
+                logger.info(f"DNS cleanup complete for {len(client_ips)} clients ({len(mapped) + len(rules_to_delete)} rules removed)")
             else:
-                logger.debug(f"No DNS rules found for {client_ip}")
+                logger.debug(f"No DNS rules found for {', '.join(sorted(client_ips))}")
                 
         except Exception as e:
-            logger.error(f"Failed to cleanup DNS for {client_ip}: {e}")
+            logger.error(f"Failed to cleanup DNS rules: {getattr(e, 'stderr', None) or e}")
+            # Rules may remain; keep them reachable for the next cleanup
+            self._untracked_ips |= client_ips
+            return
         
         # Remove from tracking
-        if client_ip in self.active_rules:
-            del self.active_rules[client_ip]
+        self._untracked_ips = untracked
+        self._first_run = False
+        for client_ip in client_ips:
+            self.active_rules.pop(client_ip, None)
 
-    
     def get_dns_rules_for_client(self, client_ip: str):
         """
         Return DNS configuration for a specific client by parsing actual iptables rules.
@@ -141,29 +490,17 @@ class DNSManager:
             dict with DNS configuration or None if no rules exist
         """
         try:
-            # Query actual iptables rules
-            result = subprocess.run([
-                IPTABLES_CMD, '-t', 'nat', '-L', 'PREROUTING', '-n', '-v'
-            ], capture_output=True, text=True, check=True)
-            
-            # Parse output to find rules for this client
-            dns_servers = []
-            for line in result.stdout.split('\n'):
-                if client_ip in line and 'dpt:53' in line and 'DNAT' in line:
-                    # Extract destination DNS server from "to:IP:53"
-                    parts = line.split('to:')
-                    if len(parts) > 1:
-                        dns_ip = parts[1].split(':')[0]
-                        if dns_ip not in dns_servers:
-                            dns_servers.append(dns_ip)
+            # Query actual iptables/nftables rules
+            client = self._snapshot_dnat_rules().get(client_ip)
+            if not client or not client['dns_servers']:
+                return None
             
-            if dns_servers:
-                return {
-                    'dns_servers': dns_servers,
-                    'primary_dns': dns_servers[0],
-                    'active': True
-                }
-            return None
+            dns_servers = client['dns_servers']
+            return {
+                'dns_servers': dns_servers,
+                'primary_dns': dns_servers[0],
+                'active': True
+            }
             
         except Exception as e:
             logger.warning(f"Failed to query iptables for {client_ip}: {e}")
@@ -178,39 +515,16 @@ class DNSManager:
             dict mapping client IPs to their DNS configurations
         """
         try:
-            # Query actual iptables rules
-            result = subprocess.run([
-                IPTABLES_CMD, '-t', 'nat', '-L', 'PREROUTING', '-n', '-v'
-            ], capture_output=True, text=True, check=True)
-            
-            # Parse output to find all DNS DNAT rules
+            # Query actual iptables/nftables rules
             rules = {}
-            for line in result.stdout.split('\n'):
-                if 'DNAT' in line and 'dpt:53' in line:
-                    # Extract source IP and destination DNS
-                    parts = line.split()
-                    if len(parts) >= 8:
-                        # Find source IP (after protocol columns)
-                        try:
-                            source_idx = parts.index('--') + 3  # Skip prot opt in out
-                            source_ip = parts[source_idx]
-                            
-                            # Extract destination DNS from "to:IP:53"
-                            for part in parts:
-                                if part.startswith('to:'):
-                                    dns_ip = part.split(':')[1]
-                                    
-                                    if source_ip not in rules:
-                                        rules[source_ip] = {
-                                            'dns_servers': [],
-                                            'primary_dns': dns_ip
-                                        }
-                                    if dns_ip not in rules[source_ip]['dns_servers']:
-                                        rules[source_ip]['dns_servers'].append(dns_ip)
-                                    break
-                        except (ValueError, IndexError):
-                            continue
-            
+            for source_ip, client in self._snapshot_dnat_rules().items():
+                dns_servers = client['dns_servers']
+                if not dns_servers:
+                    continue
+                rules[source_ip] = {
+                    'dns_servers': dns_servers,
+                    'primary_dns': dns_servers[0]
+                }
             return rules
             
         except Exception as e:
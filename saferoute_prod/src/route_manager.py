@@ -2,10 +2,10 @@ import yaml
 import os
 import logging
 from pathlib import Path
-from pyroute2 import IPRoute
 from .config import DEVICE_PRIORITY_BASE
 from .config_store import ConfigStore
 from .dns_manager import DNSManager
+from .utils import stat_key, YAML_LOADER, YAML_DUMPER
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +13,16 @@ logger = logging.getLogger(__name__)
 CONFIG_DIR = os.environ.get('CONFIG_DIR', '/app/data/configs')
 MAPPINGS_FILE = os.path.join(CONFIG_DIR, 'mappings', 'devices.yaml')
 
+# Parsed devices.yaml, keyed by stat_key()
+_MAPPINGS_CACHE = {'key': None, 'data': []}
+
+
+def _iproute():
+    """Open an IPRoute handle; pyroute2 is only imported once routes are touched."""
+    from pyroute2 import IPRoute
+    return IPRoute()
+
+
 class RouteManager:
     def __init__(self, config_store: ConfigStore):
         self.config_store = config_store
@@ -20,17 +30,34 @@ class RouteManager:
         self._ensure_mappings_file()
 
     def _ensure_mappings_file(self):
+        # Exclusive create: one syscall when the file already exists
         mappings_path = Path(MAPPINGS_FILE)
-        if not mappings_path.exists():
+        try:
+            f = open(mappings_path, 'x')
+        except FileExistsError:
+            return
+        except FileNotFoundError:
             mappings_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(mappings_path, 'w') as f:
-                yaml.dump({'devices': []}, f)
+            try:
+                f = open(mappings_path, 'x')
+            except FileExistsError:
+                return
+        with f:
+            yaml.dump({'devices': []}, f)
 
     def load_mappings(self):
+        """
+        Return the device mappings, re-parsing devices.yaml only when it
+        changed. Each mapping is a fresh copy, so callers may modify them.
+        """
         try:
-            with open(MAPPINGS_FILE, 'r') as f:
-                config = yaml.safe_load(f) or {}
-                return config.get('devices', [])
+            key = stat_key(MAPPINGS_FILE)
+            if key != _MAPPINGS_CACHE['key']:
+                with open(MAPPINGS_FILE, 'rb') as f:
+                    config = yaml.load(f.read(), Loader=YAML_LOADER) or {}
+                _MAPPINGS_CACHE['data'] = config.get('devices', [])
+                _MAPPINGS_CACHE['key'] = key
+            return [dict(m) for m in _MAPPINGS_CACHE['data']]
         except Exception:
             return []
 
@@ -38,23 +65,86 @@ class RouteManager:
         mappings_path = Path(MAPPINGS_FILE)
         mappings_path.parent.mkdir(parents=True, exist_ok=True)
         with open(mappings_path, 'w') as f:
-            yaml.dump({'devices': mappings}, f, default_flow_style=False)
+            yaml.dump({'devices': mappings}, f, Dumper=YAML_DUMPER, default_flow_style=False)
+        _MAPPINGS_CACHE['data'] = [dict(m) for m in mappings]
+        _MAPPINGS_CACHE['key'] = stat_key(mappings_path)
 
     def add_mapping(self, ip_addr, tunnel_name, active=True):
         mappings = self.load_mappings()
         
-        # Find existing mapping for this IP to preserve fields like 'active', 'nickname'
-        existing = next((m for m in mappings if m['ip'] == ip_addr), None)
-        
-        # Remove existing for this IP
-        mappings = [m for m in mappings if m['ip'] != ip_addr]
+        # Pull out the existing mapping for this IP (to preserve fields like
+        # 'active', 'nickname') and drop it from the list in one pass
+        existing = None
+        others = []
+        for m in mappings:
+            if m['ip'] == ip_addr:
+                existing = m
+            else:
+                others.append(m)
+        mappings = others
         
         # Verify tunnel exists
         profile = self.config_store.get_profile(tunnel_name)
         if not profile:
             raise ValueError(f"Tunnel '{tunnel_name}' does not exist")
         
-        # Create new mapping, preserving existing fields
+        new_mapping = self._new_mapping(existing, ip_addr, tunnel_name, active)
+        mappings.append(new_mapping)
+        self.save_mappings(mappings)
+        logger.info(f"Mapped {ip_addr} -> {tunnel_name} (active={new_mapping.get('active', True)})")
+        
+        # Apply immediately only if active
+        if new_mapping.get('active', True):
+            self.apply_rule_for_ip(ip_addr, tunnel_name)
+
+    def add_mappings_bulk(self, pairs, active=True):
+        """
+        Map many (ip_addr, tunnel_name) pairs at once: one devices.yaml
+        rewrite, one netlink socket for all routing rules and one DNS
+        transaction, instead of one of each per add_mapping() call.
+        Pairs naming a missing tunnel are logged and skipped.
+        
+        Returns:
+            list of the IPs that were mapped
+        """
+        # Keyed by IP; re-inserting moves a mapping to the end, like add_mapping
+        by_ip = {m['ip']: m for m in self.load_mappings()}
+        mapped = {}
+        for ip_addr, tunnel_name in pairs:
+            if not self.config_store.get_profile(tunnel_name):
+                logger.error(f"Tunnel '{tunnel_name}' does not exist, skipping {ip_addr}")
+                continue
+            existing = by_ip.pop(ip_addr, None)
+            by_ip[ip_addr] = mapped[ip_addr] = self._new_mapping(existing, ip_addr, tunnel_name, active)
+        
+        if not mapped:
+            return []
+        self.save_mappings(list(by_ip.values()))
+        
+        # Apply immediately only if active
+        dns_clients = []
+        with _iproute() as ipr:
+            for m in mapped.values():
+                logger.info(f"Mapped {m['ip']} -> {m['tunnel']} (active={m.get('active', True)})")
+                if not m.get('active', True):
+                    continue
+                try:
+                    client = self.apply_rule_for_ip(m['ip'], m['tunnel'], setup_dns=False, ipr=ipr)
+                    if client:
+                        dns_clients.append(client)
+                except Exception as e:
+                    logger.error(f"Failed to apply rule for {m['ip']}: {e}")
+        
+        if dns_clients:
+            try:
+                self.dns_manager.setup_dns_for_clients(dns_clients)
+            except Exception as e:
+                logger.error(f"Failed to setup DNS for {len(dns_clients)} devices: {e}")
+        return list(mapped)
+
+    @staticmethod
+    def _new_mapping(existing, ip_addr, tunnel_name, active):
+        """Create a mapping, preserving existing fields like 'active', 'nickname'."""
         new_mapping = {'ip': ip_addr, 'tunnel': tunnel_name}
         if existing:
             # Preserve all existing fields except ip and tunnel
@@ -64,14 +154,7 @@ class RouteManager:
         else:
             # New mapping - set active based on parameter
             new_mapping['active'] = active
-            
-        mappings.append(new_mapping)
-        self.save_mappings(mappings)
-        logger.info(f"Mapped {ip_addr} -> {tunnel_name} (active={new_mapping.get('active', True)})")
-        
-        # Apply immediately only if active
-        if new_mapping.get('active', True):
-            self.apply_rule_for_ip(ip_addr, tunnel_name)
+        return new_mapping
 
     def list_mappings(self):
         return self.load_mappings()
@@ -84,61 +167,63 @@ class RouteManager:
         mappings = self.load_mappings()
         logger.info(f"Syncing rules for {len(mappings)} devices")
         
-        # First, clean up ALL existing DNS rules to start fresh
-        for m in mappings:
-            try:
-                self.dns_manager.cleanup_dns_for_client(m['ip'])
-            except Exception as e:
-                logger.debug(f"No DNS rules to clean for {m['ip']}: {e}")
-        
-        # Now apply rules only for ACTIVE mappings
-        for m in mappings:
-            is_active = m.get('active', True)  # Default to active if not specified
-            
-            if is_active:
-                try:
-                    self.apply_rule_for_ip(m['ip'], m['tunnel'])
-                except Exception as e:
-                    logger.error(f"Failed to apply rule for {m['ip']}: {e}")
-            else:
-                # Inactive mapping - ensure routing rule is also removed
-                logger.info(f"Skipping inactive mapping: {m['ip']}")
-                with IPRoute() as ip:
+        # Phase 1: routing rules for every mapping over one netlink socket.
+        # DNS rules are only collected here.
+        dns_clients = []
+        with _iproute() as ipr:
+            for m in mappings:
+                is_active = m.get('active', True)  # Default to active if not specified
+                
+                if is_active:
+                    try:
+                        client = self.apply_rule_for_ip(m['ip'], m['tunnel'], setup_dns=False, ipr=ipr)
+                        if client:
+                            dns_clients.append(client)
+                    except Exception as e:
+                        logger.error(f"Failed to apply rule for {m['ip']}: {e}")
+                else:
+                    # Inactive mapping - ensure routing rule is also removed
+                    logger.info(f"Skipping inactive mapping: {m['ip']}")
                     try:
-                        ip.rule('del', src=m['ip'])
+                        ipr.rule('del', src=m['ip'])
                     except Exception:
                         pass  # Already removed
+        
+        # Phase 2: one transaction replacing every mapping's DNS rules, so
+        # inactive ones (and ones without DNS servers) lose theirs
+        try:
+            self.dns_manager.setup_dns_for_clients(dns_clients, remove=[m['ip'] for m in mappings])
+        except Exception as e:
+            logger.error(f"Failed to setup DNS for {len(dns_clients)} devices: {e}")
 
-    def apply_rule_for_ip(self, ip_addr, tunnel_name):
+    def apply_rule_for_ip(self, ip_addr, tunnel_name, setup_dns=True, ipr=None):
+        """
+        Route ip_addr through the tunnel's table and set up its DNS rules.
+        
+        With setup_dns=False the DNS step is skipped and the
+        (ip_addr, dns_servers, table_id) tuple for it is returned instead,
+        so callers can batch it into DNSManager.setup_dns_for_clients().
+        
+        Pass an open IPRoute as ipr to reuse it across many calls; otherwise
+        a fresh one is opened for this call.
+        """
         profile = self.config_store.get_profile(tunnel_name)
         if not profile:
             logger.warning(f"Skipping rule for {ip_addr}: Tunnel {tunnel_name} missing")
-            return
+            return None
 
         table_id = profile['table_id']
         
-        # Delete old rules for this IP (cleanup)
-        # Using pyroute2 to delete any rule with this src
-        with IPRoute() as ip:
-            # We must be careful not to delete system rules.
-            # But here we only target rules with source = ip_addr
-            # pyroute2.rule('del', ...) is best effort
-            try:
-                ip.rule('del', src=ip_addr)
-            except Exception:
-                pass # Usually NetlinkError if not found
-            
-            # Add new rule
-            # ip rule add from <IP> lookup <TABLE> pref <PRIO>
-            logger.info(f"Adding rule: {ip_addr} -> Table {table_id}")
-            try:
-                ip.rule('add', src=ip_addr, table=table_id, priority=DEVICE_PRIORITY_BASE)
-            except Exception as e:
-                 # Check if it exists? pyroute2 often allows duplicates if not strict.
-                 logger.error(f"Rule add failed: {e}")
+        if ipr is None:
+            with _iproute() as ip:
+                self._replace_rule(ip, ip_addr, table_id)
+        else:
+            self._replace_rule(ipr, ip_addr, table_id)
         
         # Set up DNS routing for this client
         dns_servers = profile.get('dns_servers', [])
+        if dns_servers and not setup_dns:
+            return (ip_addr, dns_servers, table_id)
         if dns_servers:
             logger.info(f"Setting up DNS for {ip_addr}: {dns_servers}")
             try:
@@ -147,33 +232,52 @@ class RouteManager:
                 logger.error(f"Failed to setup DNS for {ip_addr}: {e}")
         else:
             logger.warning(f"No DNS servers found for tunnel {tunnel_name}")
+        return None
+
+    def _replace_rule(self, ip, ip_addr, table_id):
+        """Replace the routing rule for ip_addr with one into table_id."""
+        # Delete old rules for this IP (cleanup)
+        # We must be careful not to delete system rules.
+        # But here we only target rules with source = ip_addr
+        # pyroute2.rule('del', ...) is best effort
+        try:
+            ip.rule('del', src=ip_addr)
+        except Exception:
+            pass # Usually NetlinkError if not found
+        
+        # Add new rule
+        # ip rule add from <IP> lookup <TABLE> pref <PRIO>
+        logger.info(f"Adding rule: {ip_addr} -> Table {table_id}")
+        try:
+            ip.rule('add', src=ip_addr, table=table_id, priority=DEVICE_PRIORITY_BASE)
+        except Exception as e:
+             # Check if it exists? pyroute2 often allows duplicates if not strict.
+             logger.error(f"Rule add failed: {e}")
 
     def flush_all_device_rules(self):
         """
         Remove all routing rules with our device priority.
         This cleans up before re-applying mappings.
         """
-        with IPRoute() as ip:
+        with _iproute() as ip:
             try:
-                # Get all rules
-                rules = ip.get_rules()
+                # Get our device rules (by priority); the match runs as the
+                # dump is parsed, so other rules are never collected
+                rules = ip.get_rules(
+                    match=lambda r: r.get_attr('FRA_PRIORITY') == DEVICE_PRIORITY_BASE
+                )
                 deleted_count = 0
                 
                 for rule in rules:
-                    # Check if this is one of our device rules (by priority)
-                    attrs = dict(rule['attrs'])
-                    priority = attrs.get('FRA_PRIORITY')
-                    
-                    if priority == DEVICE_PRIORITY_BASE:
-                        # This is one of our rules, delete it
-                        try:
-                            src = attrs.get('FRA_SRC')
-                            if src:
-                                ip.rule('del', src=src, priority=priority)
-                                deleted_count += 1
-                                logger.debug(f"Deleted rule for {src}")
-                        except Exception as e:
-                            logger.warning(f"Failed to delete rule: {e}")
+                    # This is one of our rules, delete it
+                    try:
+                        src = rule.get_attr('FRA_SRC')
+                        if src:
+                            ip.rule('del', src=src, priority=DEVICE_PRIORITY_BASE)
+                            deleted_count += 1
+                            logger.debug(f"Deleted rule for {src}")
+                    except Exception as e:
+                        logger.warning(f"Failed to delete rule: {e}")
                 
                 if deleted_count > 0:
                     logger.info(f"Cleaned up {deleted_count} existing device rules")
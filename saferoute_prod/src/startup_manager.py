@@ -6,9 +6,35 @@ from typing import Dict, List
 from .config_store import ConfigStore, CONFIG_DIR
 from .tunnel_manager import TunnelManager
 from .route_manager import RouteManager
+from .utils import YAML_LOADER
 
 logger = logging.getLogger(__name__)
 
+
+def _scan_conf_files(directory):
+    """
+    List the *.conf files directly inside directory in one scandir pass
+    (no glob pattern translation; hidden files are skipped like glob does).
+    A missing directory yields no files, without a separate exists() stat.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return [
+                Path(entry.path) for entry in entries
+                if entry.name.endswith('.conf') and not entry.name.startswith('.') and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def _same_dir(a, b):
+    """True if a and b are the same directory, also through symlinks."""
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False  # One of them does not exist
+
+
 class StartupManager:
     """
     Manages automatic startup from a configuration file.
@@ -47,7 +73,7 @@ class StartupManager:
         # Read the config file
         try:
             with open(config_file, 'r') as f:
-                config = yaml.safe_load(f)
+                config = yaml.load(f, Loader=YAML_LOADER)
         except Exception as e:
             raise ValueError(f"Failed to read config file: {e}")
         
@@ -62,36 +88,36 @@ class StartupManager:
         
         # Initialize tunnel names dictionary
         tunnel_names = {}
+        # Profiles imported on an earlier run, fetched once for both scans
+        existing_names = self.config_store.list_profile_names()
         
         # Step 1: Auto-discover WireGuard configs in the wireguard directory
         # This allows users to just copy .conf files and click "Apply All"
         wireguard_config_dir = Path(CONFIG_DIR) / 'wireguard'
-        if wireguard_config_dir.exists():
-            conf_files = list(wireguard_config_dir.glob("*.conf"))
-            if conf_files:
-                logger.info(f"Auto-discovering configs in {wireguard_config_dir}")
-                logger.info(f"Found {len(conf_files)} WireGuard config files")
+        conf_files = _scan_conf_files(wireguard_config_dir)
+        if conf_files:
+            logger.info(f"Auto-discovering configs in {wireguard_config_dir}")
+            logger.info(f"Found {len(conf_files)} WireGuard config files")
+            
+            for conf_file in conf_files:
+                tunnel_name = conf_file.stem
+                tunnel_names[tunnel_name] = str(conf_file)
                 
-                for conf_file in conf_files:
-                    tunnel_name = conf_file.stem
-                    tunnel_names[tunnel_name] = str(conf_file)
-                    
-                    # Check if already imported
-                    existing = self.config_store.get_profile(tunnel_name)
-                    if existing:
-                        logger.info(f"  Profile '{tunnel_name}' already imported, skipping")
-                    else:
-                        try:
-                            logger.info(f"  Importing {conf_file.name} as '{tunnel_name}'")
-                            self.config_store.import_config(str(conf_file), tunnel_name)
-                            logger.info(f"  ✓ Imported '{tunnel_name}'")
-                        except Exception as e:
-                            logger.error(f"  ✗ Failed to import {conf_file.name}: {e}")
-                            continue
+                # Check if already imported
+                if tunnel_name in existing_names:
+                    logger.info("  Profile '%s' already imported, skipping", tunnel_name)
+                else:
+                    try:
+                        logger.info("  Importing %s as '%s'", conf_file.name, tunnel_name)
+                        self.config_store.import_config(str(conf_file), tunnel_name)
+                    except Exception as e:
+                        logger.error("  ✗ Failed to import %s: %s", conf_file.name, e)
+                        continue
         
         # Step 1b: Also check the legacy wireguard_configs path from config file
-        if wireguard_dir.exists() and wireguard_dir != wireguard_config_dir:
-            conf_files = list(wireguard_dir.glob("*.conf"))
+        # (its existence was checked above)
+        if not _same_dir(wireguard_dir, wireguard_config_dir):
+            conf_files = _scan_conf_files(wireguard_dir)
             if conf_files:
                 logger.info(f"Found {len(conf_files)} additional configs in {wireguard_dir}")
                 
@@ -102,16 +128,14 @@ class StartupManager:
                     
                     tunnel_names[tunnel_name] = str(conf_file)
                     
-                    existing = self.config_store.get_profile(tunnel_name)
-                    if existing:
-                        logger.info(f"  Profile '{tunnel_name}' already exists, skipping import")
+                    if tunnel_name in existing_names:
+                        logger.info("  Profile '%s' already exists, skipping import", tunnel_name)
                     else:
                         try:
-                            logger.info(f"  Importing {conf_file.name} as '{tunnel_name}'")
+                            logger.info("  Importing %s as '%s'", conf_file.name, tunnel_name)
                             self.config_store.import_config(str(conf_file), tunnel_name)
-                            logger.info(f"  ✓ Imported '{tunnel_name}'")
                         except Exception as e:
-                            logger.error(f"  ✗ Failed to import {conf_file.name}: {e}")
+                            logger.error("  ✗ Failed to import %s: %s", conf_file.name, e)
                             continue
         
         if not tunnel_names:
@@ -125,7 +149,7 @@ class StartupManager:
         else:
             try:
                 with open(device_mappings_file, 'r') as f:
-                    mappings_config = yaml.safe_load(f)
+                    mappings_config = yaml.load(f, Loader=YAML_LOADER)
                     devices = mappings_config.get('devices', [])
                 logger.info(f"Loaded {len(devices)} device mappings from {device_mappings_file.name}")
             except Exception as e:
@@ -136,17 +160,14 @@ class StartupManager:
         logger.info("Cleaning up stale tunnels...")
         self.tunnel_manager.cleanup_stale_tunnels()
 
-        logger.info("Setting up tunnels...")
-        setup_tunnels = []
-        for tunnel_name in tunnel_names.keys():
-            try:
-                logger.info(f"Setting up tunnel '{tunnel_name}'")
-                self.tunnel_manager.setup_tunnel(tunnel_name)
-                setup_tunnels.append(tunnel_name)
-                logger.info(f"  ✓ Tunnel '{tunnel_name}' is up")
-            except Exception as e:
-                logger.error(f"  ✗ Failed to setup '{tunnel_name}': {e}")
-                continue
+        # Tunnels are independent, so they come up concurrently; failures
+        # are logged by setup_tunnels()
+        logger.info(f"Setting up tunnels: {', '.join(tunnel_names)}")
+        setup_tunnels = self.tunnel_manager.setup_tunnels(tunnel_names)
+        for tunnel_name in setup_tunnels:
+            logger.info("  ✓ Tunnel '%s' is up", tunnel_name)
+        for tunnel_name in tunnel_names.keys() - setup_tunnels:
+            logger.error("  ✗ Failed to setup '%s'", tunnel_name)
         
         # Step 4: Clean up existing device routing rules
         logger.info("Cleaning up existing device routing rules...")
@@ -155,30 +176,39 @@ class StartupManager:
         # Step 5: Map devices to tunnels
         if devices:
             logger.info("Mapping devices to tunnels...")
+            available = set(setup_tunnels)  # O(1) membership per device
+            pairs = []
             for device in devices:
                 device_ip = device.get('ip')
                 tunnel_name = device.get('tunnel')
                 active = device.get('active', True)  # Default to active if not specified
                 
                 if not device_ip or not tunnel_name:
-                    logger.warning(f"Invalid device entry: {device}")
+                    logger.warning("Invalid device entry: %s", device)
                     continue
                 
                 if not active:
-                    logger.info(f"Skipping inactive mapping: {device_ip}")
+                    logger.info("Skipping inactive mapping: %s", device_ip)
                     continue
                 
-                if tunnel_name not in setup_tunnels:
-                    logger.warning(f"  Tunnel '{tunnel_name}' not available for device {device_ip}, skipping")
+                if tunnel_name not in available:
+                    logger.warning("  Tunnel '%s' not available for device %s, skipping", tunnel_name, device_ip)
                     continue
                 
-                try:
-                    logger.info(f"Mapping {device_ip} → {tunnel_name}")
-                    self.route_manager.add_mapping(device_ip, tunnel_name)
-                    logger.info(f"  ✓ Mapped {device_ip} → {tunnel_name}")
-                except Exception as e:
-                    logger.error(f"  ✗ Failed to map {device_ip}: {e}")
-                    continue
+                logger.info("Mapping %s → %s", device_ip, tunnel_name)
+                pairs.append((device_ip, tunnel_name))
+            
+            # One devices.yaml write and one rule/DNS batch for all devices
+            try:
+                mapped = set(self.route_manager.add_mappings_bulk(pairs))
+            except Exception as e:
+                logger.error(f"  ✗ Failed to map devices: {e}")
+                mapped = set()
+            for device_ip, tunnel_name in pairs:
+                if device_ip in mapped:
+                    logger.info("  ✓ Mapped %s → %s", device_ip, tunnel_name)
+                else:
+                    logger.error("  ✗ Failed to map %s", device_ip)
         
         # Step 6: Sync rules to ensure DNS cleanup for inactive mappings
         logger.info("Syncing routing and DNS rules...")
@@ -1,31 +1,152 @@
+import errno
+import functools
 import logging
 import os
 import socket
-from pyroute2 import IPRoute, WireGuard
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .config import MAX_SETUP_WORKERS, ENDPOINT_CACHE_TTL
 from .config_store import ConfigStore
 
 logger = logging.getLogger(__name__)
 
+# Endpoint lookups run here so DNS overlaps with interface creation
+_resolver_pool = ThreadPoolExecutor(max_workers=MAX_SETUP_WORKERS, thread_name_prefix='resolver')
+
+# Resolved endpoints: host -> (ip, time.monotonic() of the lookup)
+_endpoint_cache = {}
+# Lookups in progress: host -> Future, so concurrent setups share one query
+_endpoint_inflight = {}
+_endpoint_cache_lock = threading.Lock()
+
+
+def _split_endpoint(endpoint):
+    """Split a WireGuard 'host:port' or '[v6]:port' endpoint into (host, int port)."""
+    ep_host, _, ep_port = endpoint.rpartition(':')
+    return ep_host.strip('[]'), int(ep_port)
+
+
+def _resolve_endpoint(host):
+    """
+    Resolve a WireGuard endpoint host to an IPv4 address.
+    Answers are reused for ENDPOINT_CACHE_TTL seconds. If a fresh lookup
+    fails, the last known address is returned instead of raising: endpoints
+    are often DDNS names and a slightly stale IP still works.
+    """
+    now = time.monotonic()
+    with _endpoint_cache_lock:
+        cached = _endpoint_cache.get(host)
+    if cached and now - cached[1] < ENDPOINT_CACHE_TTL:
+        return cached[0]
+
+    try:
+        # IPv4 only: endpoint pinning and the tunnel tables are IPv4
+        infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_DGRAM,
+                                   0, socket.AI_ADDRCONFIG)
+        ip_addr = infos[0][4][0]
+    except OSError as e:
+        if cached:
+            logger.warning(f"Failed to resolve {host} ({e}), reusing {cached[0]}")
+            return cached[0]
+        raise
+
+    with _endpoint_cache_lock:
+        _endpoint_cache[host] = (ip_addr, now)
+    return ip_addr
+
+
+def _endpoint_future(host):
+    """Start (or join) a background lookup of host; returns its Future."""
+    with _endpoint_cache_lock:
+        future = _endpoint_inflight.get(host)
+        if future is not None:
+            return future
+        future = _resolver_pool.submit(_resolve_endpoint, host)
+        _endpoint_inflight[host] = future
+    # Outside the lock: the callback runs right away if already done
+    future.add_done_callback(functools.partial(_forget_inflight, host))
+    return future
+
+
+def _forget_inflight(host, future):
+    with _endpoint_cache_lock:
+        if _endpoint_inflight.get(host) is future:
+            del _endpoint_inflight[host]
+
+
+def _expire_endpoint(host):
+    """
+    Force the next lookup of host to hit DNS. The old address is kept as
+    the fallback for a failed lookup.
+    """
+    with _endpoint_cache_lock:
+        cached = _endpoint_cache.get(host)
+        if cached:
+            _endpoint_cache[host] = (cached[0], float('-inf'))
+
 class TunnelManager:
     def __init__(self, config_store: ConfigStore):
         self.config_store = config_store
+        # Netlink handles (IPRoute, WireGuard) are opened lazily, one of each
+        # per thread, and reused for every operation instead of opening a
+        # fresh socket per call.
+        self._local = threading.local()
+        self._handles = []
+        self._handles_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _handle(self, attr, factory):
+        handle = getattr(self._local, attr, None)
+        if handle is None:
+            handle = factory()
+            setattr(self._local, attr, handle)
+            with self._handles_lock:
+                self._handles.append(handle)
+        return handle
+
+    def _ipr(self):
+        """Return this thread's persistent IPRoute handle, opening it on first use."""
+        from pyroute2 import IPRoute
+        return self._handle('ip', IPRoute)
+
+    def _wg(self):
+        """Return this thread's persistent WireGuard handle, opening it on first use."""
+        from pyroute2 import WireGuard
+        return self._handle('wg', WireGuard)
+
+    def close(self):
+        """Close all netlink handles opened by this manager."""
+        with self._handles_lock:
+            handles, self._handles = self._handles, []
+            self._local = threading.local()
+        for ip in handles:
+            try:
+                ip.close()
+            except Exception as e:
+                logger.debug(f"Failed to close netlink handle: {e}")
 
     def cleanup_stale_tunnels(self):
         """Clean up any pre-existing Saferoute interfaces (sr_*) from previous runs."""
         logger.info("Scanning for stale Saferoute interfaces...")
         cleaned = 0
-        with IPRoute() as ip:
-            # List all links
-            links = ip.get_links()
-            for link in links:
-                ifname = link.get_attr('IFLA_IFNAME')
-                if ifname and ifname.startswith('sr_'):
-                    try:
-                        logger.info(f"Removing stale interface: {ifname}")
-                        ip.link('del', index=link['index'])
-                        cleaned += 1
-                    except Exception as e:
-                        logger.error(f"Failed to remove {ifname}: {e}")
+        ip = self._ipr()
+        # List all links
+        links = ip.get_links()
+        for link in links:
+            ifname = link.get_attr('IFLA_IFNAME')
+            if ifname and ifname.startswith('sr_'):
+                try:
+                    logger.info(f"Removing stale interface: {ifname}")
+                    ip.link('del', index=link['index'])
+                    cleaned += 1
+                except Exception as e:
+                    logger.error(f"Failed to remove {ifname}: {e}")
         
         if cleaned > 0:
             logger.info(f"Cleaned up {cleaned} stale Saferoute interfaces")
@@ -36,28 +157,75 @@ class TunnelManager:
         Returns a dict: { 'profile_name': {'rx_bytes': int, 'tx_bytes': int}, ... }
         """
         stats = {}
-        with IPRoute() as ip:
-            links = ip.get_links()
-            for link in links:
-                ifname = link.get_attr('IFLA_IFNAME')
-                if ifname and ifname.startswith('sr_'):
-                    # Map 'sr_name' -> 'name'
-                    # But config_store generates 'sr_name' from 'name'. 
-                    # We might need to look up profile by ifname or just rely on convention.
-                    # Convention: sr_{name} but name might be truncated.
-                    # Actually config_store.get_profile(name) -> ifname="sr_"+name
-                    # So we can just strip "sr_" for display purposes or try to match exactly if needed.
-                    profile_name = ifname[3:] # Strip 'sr_' prefix
-                    
-                    # specific stats are in IFLA_STATS64 or IFLA_STATS
-                    link_stats = link.get_attr('IFLA_STATS64') or link.get_attr('IFLA_STATS')
-                    if link_stats:
-                        stats[profile_name] = {
-                            'rx_bytes': link_stats['rx_bytes'],
-                            'tx_bytes': link_stats['tx_bytes']
-                        }
+        links = self._ipr().get_links()
+        for link in links:
+            ifname = link.get_attr('IFLA_IFNAME')
+            if ifname and ifname.startswith('sr_'):
+                # Map 'sr_name' -> 'name'
+                # But config_store generates 'sr_name' from 'name'. 
+                # We might need to look up profile by ifname or just rely on convention.
+                # Convention: sr_{name} but name might be truncated.
+                # Actually config_store.get_profile(name) -> ifname="sr_"+name
+                # So we can just strip "sr_" for display purposes or try to match exactly if needed.
+                profile_name = ifname[3:] # Strip 'sr_' prefix
+                
+                # specific stats are in IFLA_STATS64 or IFLA_STATS
+                link_stats = link.get_attr('IFLA_STATS64') or link.get_attr('IFLA_STATS')
+                if link_stats:
+                    stats[profile_name] = {
+                        'rx_bytes': link_stats['rx_bytes'],
+                        'tx_bytes': link_stats['tx_bytes']
+                    }
         return stats
 
+    def get_wireguard_status(self):
+        """
+        Render `wg show`-style status for all Saferoute tunnels via netlink.
+        Returns an empty string when no tunnel is up.
+        """
+        sections = []
+        wg = self._wg()
+        for profile in self.config_store.list_profiles().values():
+            ifname = profile['interface_name']
+            try:
+                info = wg.info(ifname)
+            except Exception:
+                continue  # Interface not up
+            if info:
+                sections.append(_format_wg_info(ifname, info[0]))
+        return '\n\n'.join(sections)
+
+    def setup_tunnels(self, names):
+        """
+        Set up several tunnels concurrently.
+        Failures are logged and skipped; returns the names that came up,
+        in the order given.
+        """
+        names = list(names)
+        if not names:
+            return []
+
+        # Resolve every endpoint up front so all lookups overlap, not just
+        # those of the tunnels that currently have a worker
+        for name in names:
+            profile = self.config_store.get_profile(name)
+            try:
+                _endpoint_future(_split_endpoint(profile['endpoint'])[0])
+            except Exception:
+                pass  # setup_tunnel reports bad profiles
+
+        def setup(name):
+            try:
+                self.setup_tunnel(name)
+                return True
+            except Exception as e:
+                logger.error(f"Failed to setup tunnel {name}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=min(MAX_SETUP_WORKERS, len(names))) as pool:
+            results = list(pool.map(setup, names))
+        return [name for name, ok in zip(names, results) if ok]
+
     def setup_tunnel(self, name):
         profile = self.config_store.get_profile(name)
         if not profile:
@@ -69,53 +237,57 @@ class TunnelManager:
 
         logger.info(f"Setting up tunnel {name} on {ifname} (Table {table_id})")
 
-        # 1. Cleanup existing
-        self.teardown_tunnel(name)
-
-        # 2. Parse Config
+        # 1. Parse Config
         parsed = self.config_store._parse_wg_config(config_path)
 
         priv_key = parsed['Interface'].get('PrivateKey').strip()
         address_cidr = parsed['Interface'].get('Address').strip()
+        wg_ip, _, wg_mask = address_cidr.partition('/')
         peer_pub = parsed['Peer'].get('PublicKey').strip()
         endpoint = parsed['Peer'].get('Endpoint').strip()
         allowed_ips = parsed['Peer'].get('AllowedIPs', '0.0.0.0/0').strip()
 
-        # Resolve Endpoint
+        # Start resolving the endpoint now; it is only needed for the peer config
         try:
-            ep_host, ep_port = endpoint.split(':')
-            ep_ip = socket.gethostbyname(ep_host)
-            ep_port = int(ep_port)
+            ep_host, ep_port = _split_endpoint(endpoint)
         except Exception as e:
-            logger.error(f"Failed to resolve endpoint {endpoint}: {e}")
+            logger.error(f"Invalid endpoint {endpoint}: {e}")
             raise
+        ep_future = _endpoint_future(ep_host)
+
+        # 2. Cleanup existing
+        self._delete_link(name, ifname)
 
         # 3. Create Interface & Configure WireGuard (NETLINK)
-        with IPRoute() as ip:
-            # Create interface
-            # ip link add dev <ifname> type wireguard
-            ip.link('add', ifname=ifname, kind='wireguard')
-            
-            # Get interface index
-            idx = ip.link_lookup(ifname=ifname)[0]
-            
-            # Set MTU
-            ip.link('set', index=idx, mtu=1280)
-            
-            # Add Address
-            # ip addr add <address> dev <ifname>
-            ip.addr('add', index=idx, address=address_cidr.split('/')[0], mask=int(address_cidr.split('/')[1]))
-            
-            # Bring Up
-            ip.link('set', index=idx, state='up')
+        ip = self._ipr()
+
+        # Create interface with its MTU in the same request
+        # ip link add dev <ifname> mtu 1280 type wireguard
+        ip.link('add', ifname=ifname, kind='wireguard', mtu=1280)
+        
+        # Get interface index (reused for the table route below)
+        idx = ip.link_lookup(ifname=ifname)[0]
+        
+        # Add Address
+        # ip addr add <address> dev <ifname>
+        ip.addr('add', index=idx, address=wg_ip, mask=int(wg_mask))
+        
+        # Bring Up
+        ip.link('set', index=idx, state='up')
+
+        # Resolve Endpoint (no deadline of our own; the resolver's retries
+        # decide, as they did for a direct gethostbyname)
+        try:
+            ep_ip = ep_future.result()
+        except Exception as e:
+            logger.error(f"Failed to resolve endpoint {endpoint}: {e}")
+            self._delete_link(name, ifname)
+            raise
 
         # 4. Configure WireGuard (Keys/Peers)
         # We need to construct the peer dict for pyroute2.WireGuard
         # valid keys for set: 'private_key', 'listen_port', 'fwmark', 'peer_d'
         # peer_d is a list of dicts.
-        
-        wg = WireGuard()
-        
 
         if allowed_ips:
             # Parse comma-separated IPs into list
@@ -135,8 +307,7 @@ class TunnelManager:
         logger.info("Configuring WireGuard crypto details via Netlink")
         # Pass peer as a DICT, not a list.
         # Pass keys as STRINGS (Base64), not bytes.
-        wg.set(ifname, private_key=priv_key, peer=peer_dict)
-        wg.close()
+        self._wg().set(ifname, private_key=priv_key, peer=peer_dict)
 
 
         # 6. Pin Endpoint (Critical)
@@ -144,19 +315,16 @@ class TunnelManager:
 
         # 7. Add Default Route to Table
         logger.info(f"Adding default route to table {table_id}")
-        with IPRoute() as ip:
-            idx = ip.link_lookup(ifname=ifname)[0]
-            # ip route add default dev ifname table table_id
-            try:
-                ip.route('add', dst='0.0.0.0/0', table=table_id, oif=idx)
-            except Exception as e:
-                logger.error(f"Failed to add default route: {e}")
-                # EEXIST?
-                pass
+        # ip route add default dev ifname table table_id
+        try:
+            ip.route('add', dst='0.0.0.0/0', table=table_id, oif=idx)
+        except Exception as e:
+            logger.error(f"Failed to add default route: {e}")
+            # EEXIST?
+            pass
 
         # 8. Add Rule for return traffic
         # ip rule add from <WG_IP> lookup <table_id>
-        wg_ip = address_cidr.split('/')[0]
         self._add_rule(wg_ip, table_id)
 
     def teardown_tunnel(self, name):
@@ -164,57 +332,85 @@ class TunnelManager:
         if not profile:
              return
 
-        ifname = profile['interface_name']
-        
-        with IPRoute() as ip:
-            if ip.link_lookup(ifname=ifname):
-                logger.info(f"Tearing down {name} ({ifname})")
-                ip.link('del', ifname=ifname)
-            
-        pass
+        self._delete_link(name, profile['interface_name'])
+
+        # Re-resolve the endpoint on the next setup
+        try:
+            _expire_endpoint(_split_endpoint(profile['endpoint'])[0])
+        except Exception:
+            pass
+
+    def _delete_link(self, name, ifname):
+        # Delete directly; a missing link is reported as ENODEV, which saves
+        # a separate lookup round trip on first setup
+        from pyroute2.netlink.exceptions import NetlinkError
+        try:
+            self._ipr().link('del', ifname=ifname)
+        except NetlinkError as e:
+            if e.code != errno.ENODEV:
+                raise
+            return
+        logger.info(f"Tore down {name} ({ifname})")
 
     def _pin_route(self, ip_addr):
         """
         Ensure traffic to the VPN endpoint goes through the physical gateway.
         Using pyroute2 to find default gateway and add host route.
         """
-        with IPRoute() as ip:
-            # Find default route in main table (254)
-            # Avoid using get_routes(dst='default') as it causes EOPNOTSUPP
-            routes = ip.get_routes(table=254)
-            # Filter for default route (dst_len=0 and no RTA_DST)
-            default_routes = [r for r in routes if r['dst_len'] == 0]
-            if not default_routes:
-                logger.warning("No default gateway found, skipping pinning.")
-                return
-            
-            # Pick first default route
-            r = default_routes[0]
-            gw = None
-            oif = None
-            
-            # Parse route attributes
-            for attr, val in r['attrs']:
-                if attr == 'RTA_GATEWAY':
-                    gw = val
-                if attr == 'RTA_OIF':
-                    oif = val
-            
-            if gw and oif:
-                ifname_out = ip.get_links(oif)[0].get_attr('IFLA_IFNAME')
-                logger.info(f"Pinning {ip_addr} via {gw} ({ifname_out})")
-                # ip route add <ip>/32 via <gw> dev <oif>
-                try:
-                    ip.route('add', dst=f"{ip_addr}/32", gateway=gw, oif=oif)
-                except Exception as e:
-                    # EEXIST is common
-                    pass
+        ip = self._ipr()
+        # Ask the kernel which route the endpoint takes instead of dumping the
+        # main table (get_routes(dst='default') causes EOPNOTSUPP)
+        try:
+            r = ip.route('get', dst=ip_addr)[0]
+        except Exception as e:
+            logger.warning(f"No route to {ip_addr} ({e}), skipping pinning.")
+            return
 
-    def _add_rule(self, ip_addr, table_id):
-        with IPRoute() as ip:
-            # ip rule add from <ip> lookup <table>
-            # pyroute2 doesn't have a high level 'add_rule', we use 'rule' command
+        gw = r.get_attr('RTA_GATEWAY')
+        oif = r.get_attr('RTA_OIF')
+
+        if gw and oif:
+            ifname_out = ip.get_links(oif)[0].get_attr('IFLA_IFNAME')
+            logger.info(f"Pinning {ip_addr} via {gw} ({ifname_out})")
+            # ip route add <ip>/32 via <gw> dev <oif>
             try:
-                ip.rule('add', src=ip_addr, table=table_id)
-            except Exception:
+                ip.route('add', dst=f"{ip_addr}/32", gateway=gw, oif=oif)
+            except Exception as e:
+                # EEXIST is common
                 pass
+
+    def _add_rule(self, ip_addr, table_id):
+        # ip rule add from <ip> lookup <table>
+        # pyroute2 doesn't have a high level 'add_rule', we use 'rule' command
+        try:
+            self._ipr().rule('add', src=ip_addr, table=table_id)
+        except Exception:
+            pass
+
+
+def _format_wg_info(ifname, msg):
+    """Format a WireGuard netlink info message like `wg show` does."""
+    def text(value):
+        return value.decode() if isinstance(value, bytes) else str(value)
+
+    lines = [f"interface: {ifname}"]
+    public_key = msg.get_attr('WGDEVICE_A_PUBLIC_KEY')
+    if public_key:
+        lines.append(f"  public key: {text(public_key)}")
+    listen_port = msg.get_attr('WGDEVICE_A_LISTEN_PORT')
+    if listen_port:
+        lines.append(f"  listening port: {listen_port}")
+
+    for peer in msg.get_attr('WGDEVICE_A_PEERS') or []:
+        lines.append("")
+        lines.append(f"peer: {text(peer.get_attr('WGPEER_A_PUBLIC_KEY'))}")
+        endpoint = peer.get_attr('WGPEER_A_ENDPOINT')
+        if endpoint and endpoint.get('addr'):
+            lines.append(f"  endpoint: {endpoint['addr']}:{endpoint['port']}")
+        handshake = peer.get_attr('WGPEER_A_LAST_HANDSHAKE_TIME')
+        if handshake and handshake.get('tv_sec'):
+            lines.append(f"  latest handshake: {int(time.time()) - handshake['tv_sec']} seconds ago")
+        rx_bytes = peer.get_attr('WGPEER_A_RX_BYTES') or 0
+        tx_bytes = peer.get_attr('WGPEER_A_TX_BYTES') or 0
+        lines.append(f"  transfer: {rx_bytes} B received, {tx_bytes} B sent")
+    return '\n'.join(lines)
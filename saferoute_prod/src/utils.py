@@ -1,6 +1,11 @@
 import logging
 import os
-from pyroute2 import IPRoute
+import shutil
+import yaml
+
+# libyaml's C loader/dumper when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
 
 def setup_logging(level=logging.INFO):
     logging.basicConfig(
@@ -12,13 +17,25 @@ def setup_logging(level=logging.INFO):
 def get_env_var(name, default=None):
     return os.environ.get(name, default)
 
+def stat_key(path):
+    """Cache key that changes whenever the file is rewritten."""
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+def _write_sysctl(path, value):
+    """Write a /proc/sys value with a raw fd (no buffered text file objects)."""
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.write(fd, value)
+    finally:
+        os.close(fd)
+
 def enable_ipv4_forwarding():
     """
     Equivalent to sysctl -w net.ipv4.ip_forward=1
     """
     try:
-        with open('/proc/sys/net/ipv4/ip_forward', 'w') as f:
-            f.write('1')
+        _write_sysctl('/proc/sys/net/ipv4/ip_forward', b'1')
     except Exception as e:
         logging.getLogger('utils').error(f"Failed to enable ip_forward: {e}")
 
@@ -28,8 +45,7 @@ def enable_src_valid_mark():
     Required for WireGuard routing with fwmark.
     """
     try:
-        with open('/proc/sys/net/ipv4/conf/all/src_valid_mark', 'w') as f:
-            f.write('1')
+        _write_sysctl('/proc/sys/net/ipv4/conf/all/src_valid_mark', b'1')
     except Exception as e:
         logging.getLogger('utils').error(f"Failed to enable src_valid_mark: {e}")
 def enable_forwarding_allow():
@@ -137,51 +153,59 @@ def enable_masquerade():
         logger.warning(f"nftables approach failed: {e}")
         logger.info("Falling back to legacy iptables approach")
         
-        # Fallback: Use iptables via subprocess (but with better detection)
+        # Fallback: Use iptables via subprocess. The binary was already
+        # picked (iptables-legacy preferred) by a PATH lookup at import.
         import subprocess
+        from .dns_manager import IPTABLES_CMD, IPTABLES_SAVE_CMD, IPTABLES_RESTORE_CMD
         
-        iptables_cmd = None
-        for cmd in ['iptables-legacy', 'iptables']:
-            try:
-                result = subprocess.run([cmd, '-t', 'nat', '-L', '-n'], 
-                                      capture_output=True, timeout=2)
-                if result.returncode == 0:
-                    iptables_cmd = cmd
-                    logger.info(f"Using {cmd} for NAT rules")
-                    break
-            except (subprocess.TimeoutExpired, FileNotFoundError):
-                continue
-        
+        iptables_cmd = shutil.which(IPTABLES_CMD)
         if not iptables_cmd:
-            logger.error("No working iptables command found")
+            logger.error("No iptables command found")
             return
+        logger.info(f"Using {iptables_cmd} for NAT rules")
         
+        # One dump to see which rules exist, then one restore adding the
+        # missing ones (instead of a -C check and -A add per rule)
         try:
-            result = subprocess.run(
-                [iptables_cmd, "-t", "nat", "-A", "POSTROUTING", "-o", "sr_+", "-j", "MASQUERADE"],
-                capture_output=True, text=True
-            )
-            if result.returncode != 0 and "already exists" not in result.stderr.lower():
-                logger.warning(f"Failed to add MASQUERADE rule: {result.stderr}")
-            else:
-                logger.info("NAT masquerading enabled (via iptables-legacy)")
+            dump = subprocess.run([IPTABLES_SAVE_CMD], capture_output=True, text=True,
+                                  check=True, close_fds=False).stdout
         except Exception as e:
-            logger.error(f"Exception setting up masquerade: {e}")
-
+            logger.error(f"Failed to read iptables rules: {e}")
+            return
+        
+        existing = set()
+        table = None
+        for line in dump.splitlines():
+            if line.startswith('*'):
+                table = line[1:]
+            elif line.startswith('-A POSTROUTING '):
+                if table == 'nat' and line == '-A POSTROUTING -o sr_+ -j MASQUERADE':
+                    existing.add('masquerade')
+                elif table == 'mangle' and '-j TCPMSS' in line and '--clamp-mss-to-pmtu' in line:
+                    existing.add('mss')
+        
+        blob = ''
+        if 'masquerade' not in existing:
+            blob += '*nat\n-A POSTROUTING -o sr_+ -j MASQUERADE\nCOMMIT\n'
         # Also add TCP MSS clamping - critical for VPN performance
         # iptables -t mangle -A POSTROUTING -p tcp --tcp-flags SYN,RST SYN -j TCPMSS --clamp-mss-to-pmtu
+        if 'mss' not in existing:
+            blob += ('*mangle\n-A POSTROUTING -p tcp -m tcp --tcp-flags SYN,RST SYN '
+                     '-j TCPMSS --clamp-mss-to-pmtu\nCOMMIT\n')
+        if not blob:
+            logger.info("NAT masquerading and TCP MSS clamping already enabled")
+            return
+        
         try:
-            # Check if mangle table rule exists
-            res = subprocess.run(
-                [iptables_cmd, "-t", "mangle", "-C", "POSTROUTING", "-p", "tcp", "--tcp-flags", "SYN,RST", "SYN", "-j", "TCPMSS", "--clamp-mss-to-pmtu"],
-                capture_output=True
-            )
-            if res.returncode != 0:
-                subprocess.run(
-                    [iptables_cmd, "-t", "mangle", "-A", "POSTROUTING", "-p", "tcp", "--tcp-flags", "SYN,RST", "SYN", "-j", "TCPMSS", "--clamp-mss-to-pmtu"],
-                    check=False
-                )
-                logger.info("TCP MSS clamping enabled (fixes slow VPN speeds)")
-        except Exception:
-            logger.warning("Failed to enable TCP MSS clamping")
-
+            result = subprocess.run([IPTABLES_RESTORE_CMD, '--noflush'], input=blob,
+                                    capture_output=True, text=True, close_fds=False)
+            if result.returncode != 0:
+                logger.warning(f"Failed to add NAT rules: {result.stderr}")
+                return
+        except Exception as e:
+            logger.error(f"Exception setting up masquerade: {e}")
+            return
+        if 'masquerade' not in existing:
+            logger.info("NAT masquerading enabled (via iptables-legacy)")
+        if 'mss' not in existing:
+            logger.info("TCP MSS clamping enabled (fixes slow VPN speeds)")